@@ -13,12 +13,13 @@ Resizefs
 
 Resize a filesystem to use all avaliable space on partition. This module is
 useful along with ``cc_growpart`` and will ensure that if the root partition
-has been resized the root filesystem will be resized along with it. By default,
-``cc_resizefs`` will resize the root partition and will block the boot process
-while the resize command is running. Optionally, the resize operation can be
-performed in the background while cloud-init continues running modules. This
-can be enabled by setting ``resize_rootfs`` to ``true``. This module can be
-disabled altogether by setting ``resize_rootfs`` to ``false``.
+has been resized the root filesystem will be resized along with it. By
+default, ``cc_resizefs`` will resize the root partition in the background
+while cloud-init continues running modules, so the boot process is not
+blocked while the resize command is running. Setting ``resize_rootfs`` to
+``true`` will cause the resize to block the boot process instead. This
+module can be disabled altogether by setting ``resize_rootfs`` to
+``false``.
 
 **Internal name:** ``cc_resizefs``
 
@@ -28,22 +29,41 @@ disabled altogether by setting ``resize_rootfs`` to ``false``.
 
 **Config keys**::
 
-    resize_rootfs: <true/false/"noblock">
+    resize_rootfs: <true/false/"noblock">  (default: "noblock")
     resize_rootfs_tmp: <directory>
 """
 
 import errno
-import getopt
+import fcntl
+import functools
+import logging
 import os
 import re
-import shlex
+import select
 import stat
+import struct
+import threading
 
 from cloudinit.settings import PER_ALWAYS
 from cloudinit import util
 
 frequency = PER_ALWAYS
 
+# Matches the '-s <size>' and '-f <frag-size>' options in the newfs
+# command line reported by 'dumpfs -m'.
+_NEWFS_OPT_RE = re.compile(r'-([sf])\s+(\d+)')
+
+# Splits a FreeBSD partition device path into disk device and partition
+# number, e.g. '/dev/da0p2' -> ('/dev/da0', '2').
+_DEVPTH_RE = re.compile(r'^(/dev/.+)p([0-9])$')
+
+# Linux ioctl returning the size of a block device in bytes (u64).
+BLKGETSIZE64 = 0x80081272
+
+# Largest difference between device size and filesystem size that is
+# still considered "already full size"; one ext4 block group.
+_RESIZE_SLACK_BYTES = 128 * 1024 * 1024
+
 
 def _resize_btrfs(mount_point, devpth):
     return ('btrfs', 'filesystem', 'resize', 'max', mount_point)
@@ -61,14 +81,52 @@ def _resize_ufs(mount_point, devpth):
     return ('growfs', devpth)
 
 
+def _run_for_stdout(cmd):
+    # Lighter-weight than util.subp for the simple "run and read
+    # stdout" case; failures are re-raised as ProcessExecutionError so
+    # callers see the same exception type subp would raise.
+    # Imported here as only the (FreeBSD-only) UFS precheck uses it.
+    import subprocess
+    try:
+        proc = subprocess.run(cmd, stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE, check=True,
+                              universal_newlines=True)
+    except subprocess.CalledProcessError as e:
+        raise util.ProcessExecutionError(stdout=e.stdout, stderr=e.stderr,
+                                         exit_code=e.returncode, cmd=cmd)
+    return proc.stdout
+
+
 def _get_dumpfs_output(mount_point):
-    dumpfs_res, err = util.subp(['dumpfs', '-m', mount_point])
-    return dumpfs_res
+    return _run_for_stdout(['dumpfs', '-m', mount_point])
 
 
 def _get_gpart_output(part):
-    gpart_res, err = util.subp(['gpart', 'show', part])
-    return gpart_res
+    return _run_for_stdout(['gpart', 'show', part])
+
+
+def _get_device_size_bytes(devpth):
+    fd = os.open(devpth, os.O_RDONLY)
+    try:
+        buf = fcntl.ioctl(fd, BLKGETSIZE64, struct.pack('Q', 0))
+    finally:
+        os.close(fd)
+    return struct.unpack('Q', buf)[0]
+
+
+def _can_skip_resize_ext(mount_point, devpth):
+    # If the filesystem already spans the whole block device there is
+    # nothing for the resizer to do; compare the device size (via
+    # BLKGETSIZE64) against the filesystem size from statvfs.  The
+    # filesystem is always somewhat smaller than the device due to
+    # metadata, so allow up to one block group of slack.
+    try:
+        dev_sz = _get_device_size_bytes(devpth)
+    except (OSError, IOError):
+        return False
+    st = os.statvfs(mount_point)
+    fs_sz = st.f_blocks * st.f_frsize
+    return dev_sz - fs_sz < _RESIZE_SLACK_BYTES
 
 
 def _can_skip_resize_ufs(mount_point, devpth):
@@ -79,19 +137,26 @@ def _can_skip_resize_ufs(mount_point, devpth):
       newfs -O 2 -U -a 4 -b 32768 -d 32768 -e 4096 -f 4096 -g 16384
             -h 64 -i 8192 -j -k 6408 -m 8 -o time -s 58719232 /dev/label/rootf
     """
-    cur_fs_sz = None
-    frag_sz = None
-    dumpfs_res = _get_dumpfs_output(mount_point)
+    # dumpfs and gpart are independent of each other, so run both
+    # concurrently and overlap their fork+exec+wait latency.  The
+    # import is deferred since only this FreeBSD-only path needs it.
+    from concurrent.futures import ThreadPoolExecutor
+    m = _DEVPTH_RE.match(devpth)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        dumpfs_fut = executor.submit(_get_dumpfs_output, mount_point)
+        gpart_fut = executor.submit(_get_gpart_output, m.group(1))
+        dumpfs_res = dumpfs_fut.result()
+        gpart_res = gpart_fut.result()
+    sizes = {'s': None, 'f': None}
     for line in dumpfs_res.splitlines():
         if not line.startswith('#'):
-            newfs_cmd = shlex.split(line)
-            opt_value = 'O:Ua:s:b:d:e:f:g:h:i:jk:m:o:'
-            optlist, args = getopt.getopt(newfs_cmd[1:], opt_value)
-            for o, a in optlist:
-                if o == "-s":
-                    cur_fs_sz = int(a)
-                if o == "-f":
-                    frag_sz = int(a)
+            for m in _NEWFS_OPT_RE.finditer(line):
+                sizes[m.group(1)] = int(m.group(2))
+    cur_fs_sz = sizes['s']
+    frag_sz = sizes['f']
+    # without both sizes there is nothing to compare against.
+    if cur_fs_sz is None or frag_sz is None or frag_sz % 512 != 0:
+        return False
     # check the current partition size
     """
     # gpart show /dev/da0
@@ -102,37 +167,64 @@ def _can_skip_resize_ufs(mount_point, devpth):
   61866024   1048496       - free -  (512M)
     """
     expect_sz = None
-    m = re.search('^(/dev/.+)p([0-9])$', devpth)
-    gpart_res = _get_gpart_output(m.group(1))
     for line in gpart_res.splitlines():
-        if re.search(r"freebsd-ufs", line):
+        if "freebsd-ufs" in line:
             fields = line.split()
             expect_sz = int(fields[1])
     # Normalize the gpart sector size,
     # because the size is not exactly the same as fs size.
-    normal_expect_sz = (expect_sz - expect_sz % (frag_sz / 512))
+    # Use integer division; true division would make the modulus a
+    # float and the equality test below unreliable.
+    normal_expect_sz = (expect_sz - expect_sz % (frag_sz // 512))
     if normal_expect_sz == cur_fs_sz:
         return True
     else:
         return False
 
 
-# Do not use a dictionary as these commands should be able to be used
-# for multiple filesystem types if possible, e.g. one command for
-# ext2, ext3 and ext4.
-RESIZE_FS_PREFIXES_CMDS = [
-    ('btrfs', _resize_btrfs),
-    ('ext', _resize_ext),
-    ('xfs', _resize_xfs),
-    ('ufs', _resize_ufs),
-]
+# Dispatch on the first three characters of the lowercased filesystem
+# type.  This keeps one command usable for multiple filesystem types
+# (e.g. resize2fs for ext2, ext3 and ext4) while making the lookup a
+# single dict probe instead of a linear prefix scan.
+RESIZE_FS_PREFIXES_CMDS = {
+    'btr': _resize_btrfs,
+    'ext': _resize_ext,
+    'xfs': _resize_xfs,
+    'ufs': _resize_ufs,
+}
 
 RESIZE_FS_PRECHECK_CMDS = {
-    'ufs': _can_skip_resize_ufs
+    'ext': _can_skip_resize_ext,
+    'ufs': _can_skip_resize_ufs,
+    'xfs': _can_skip_resize_ext,
 }
 
+
+# The lookups are pure functions of the lowercased filesystem type, so
+# memoize them; with PER_ALWAYS frequency the module can run more than
+# once in the same interpreter.
+@functools.lru_cache(maxsize=16)
+def _lookup_resizer(fstype_lc):
+    return RESIZE_FS_PREFIXES_CMDS.get(fstype_lc[:3])
+
+
+@functools.lru_cache(maxsize=16)
+def _lookup_precheck(fstype_lc):
+    return RESIZE_FS_PRECHECK_CMDS.get(fstype_lc[:3])
+
 NOBLOCK = "noblock"
 
+# Cached result of util.is_container().  Checking for a container shells
+# out, and the answer cannot change for the lifetime of the process.
+_CONTAINER = None
+
+
+def _is_container():
+    global _CONTAINER
+    if _CONTAINER is None:
+        _CONTAINER = util.is_container()
+    return _CONTAINER
+
 
 def rootdev_from_cmdline(cmdline):
     found = None
@@ -153,24 +245,81 @@ def rootdev_from_cmdline(cmdline):
     return "/dev/" + found
 
 
-def can_skip_resize(fs_type, resize_what, devpth):
-    fstype_lc = fs_type.lower()
-    for i, func in RESIZE_FS_PRECHECK_CMDS.items():
-        if fstype_lc.startswith(i):
-            return func(resize_what, devpth)
+def can_skip_resize(fs_type_lc, resize_what, devpth):
+    func = _lookup_precheck(fs_type_lc)
+    if func:
+        return func(resize_what, devpth)
     return False
 
 
-def handle(name, cfg, _cloud, log, args):
+class _SkipResize(Exception):
+    # Raised to abort the resize.  Carries the log level and a deferred
+    # message so formatting only happens at the single handler in
+    # handle(), the one exit point for all skip reasons.
+
+    def __init__(self, level, fmt, *fmt_args):
+        super(_SkipResize, self).__init__(fmt)
+        self.level = level
+        self.fmt = fmt
+        self.fmt_args = fmt_args
+
+
+def _skip_warn(fmt, *args):
+    raise _SkipResize('warn', fmt, *args)
+
+
+def _write_resize_sentinel(sentinel, devpth, log):
+    # Record the size the device had when the filesystem last matched
+    # it, so later boots can skip the module with a single comparison.
+    try:
+        util.write_file(sentinel,
+                        "%s %d\n" % (devpth, _get_device_size_bytes(devpth)))
+    except (IOError, OSError) as e:
+        log.debug("Unable to write resize sentinel %s: %s", sentinel, e)
+
+
+def _devsize_unchanged(sentinel):
+    # True when the sentinel exists and the device it names is still
+    # the size recorded at the last successful resize.
+    try:
+        devpth, recorded = util.load_file(sentinel).split()
+        return _get_device_size_bytes(devpth) == int(recorded)
+    except (IOError, OSError, ValueError):
+        return False
+
+
+def handle(name, cfg, cloud, log, args):
+    try:
+        _handle(name, cfg, cloud, log, args)
+    except _SkipResize as skip:
+        getattr(log, skip.level)(skip.fmt, *skip.fmt_args)
+
+
+def _handle(name, cfg, cloud, log, args):
     if len(args) != 0:
         resize_root = args[0]
     else:
-        resize_root = util.get_cfg_option_str(cfg, "resize_rootfs", True)
+        resize_root = util.get_cfg_option_str(cfg, "resize_rootfs", NOBLOCK)
 
     if not util.translate_bool(resize_root, addons=[NOBLOCK]):
         log.debug("Skipping module named %s, resizing disabled", name)
         return
 
+    # In a container the rootfs resize is always a no-op, so bail out
+    # before probing the filesystem at all.
+    if _is_container():
+        log.debug("Skipping module named %s, resizing "
+                  "disabled in container", name)
+        return
+
+    # If a previous boot already resized the filesystem and the device
+    # has not grown since, there is nothing to do.
+    sentinel = os.path.join(cloud.get_ipath_cur(), 'resizefs.done')
+    if _devsize_unchanged(sentinel):
+        log.debug("Skipping module named %s, device size unchanged "
+                  "since last resize", name)
+        return
+
     # TODO(harlowja) is the directory ok to be used??
     resize_root_d = util.get_cfg_option_str(cfg, "resize_rootfs_tmp", "/run")
     util.ensure_dir(resize_root_d)
@@ -179,89 +328,77 @@ def handle(name, cfg, _cloud, log, args):
     resize_what = "/"
     result = util.get_mount_info(resize_what, log)
     if not result:
-        log.warn("Could not determine filesystem type of %s", resize_what)
-        return
+        _skip_warn("Could not determine filesystem type of %s", resize_what)
 
-    (devpth, fs_type, mount_point) = result
+    devpth = result.devpth
+    fs_type = result.fs_type
+    mount_point = result.mount_point
+    fstype_lc = result.fs_type_lc
 
     info = "dev=%s mnt_point=%s path=%s" % (devpth, mount_point, resize_what)
-    log.debug("resize_info: %s" % info)
-
-    container = util.is_container()
-
-    # Ensure the path is a block device.
-    if (devpth == "/dev/root" and not os.path.exists(devpth) and
-            not container):
-        devpth = util.rootdev_from_cmdline(util.get_cmdline())
-        if devpth is None:
-            log.warn("Unable to find device '/dev/root'")
-            return
-        log.debug("Converted /dev/root to '%s' per kernel cmdline", devpth)
+    log.debug("resize_info: %s", info)
+
+    # Ensure the path is a block device.  On modern distros /dev/root
+    # is a symlink to the real device, so a single readlink resolves
+    # it; only fall back to parsing the kernel cmdline when it is not.
+    if devpth == "/dev/root":
+        try:
+            link = os.readlink(devpth)
+            devpth = os.path.normpath(
+                os.path.join(os.path.dirname(devpth), link))
+            log.debug("Resolved /dev/root to '%s' via readlink", devpth)
+        except OSError:
+            devpth = util.rootdev_from_cmdline(util.get_cmdline())
+            if devpth is None:
+                _skip_warn("Unable to find device '/dev/root'")
+            log.debug("Converted /dev/root to '%s' per kernel cmdline",
+                      devpth)
 
     try:
         statret = os.stat(devpth)
     except OSError as exc:
-        if container and exc.errno == errno.ENOENT:
-            log.debug("Device '%s' did not exist in container. "
-                      "cannot resize: %s", devpth, info)
-        elif exc.errno == errno.ENOENT:
-            log.warn("Device '%s' did not exist. cannot resize: %s",
-                     devpth, info)
-        else:
+        if exc.errno != errno.ENOENT:
             raise exc
-        return
+        _skip_warn("Device '%s' did not exist. cannot resize: %s",
+                   devpth, info)
 
-    if not os.access(devpth, os.W_OK):
-        if container:
-            log.debug("'%s' not writable in container. cannot resize: %s",
-                      devpth, info)
-        else:
-            log.warn("'%s' not writable. cannot resize: %s", devpth, info)
-        return
+    # Derive writability from the stat we already have rather than
+    # issuing a second syscall via os.access; cloud-init runs as root.
+    if not (statret.st_mode & stat.S_IWUSR and os.geteuid() == 0):
+        _skip_warn("'%s' not writable. cannot resize: %s", devpth, info)
 
     if not stat.S_ISBLK(statret.st_mode) and not stat.S_ISCHR(statret.st_mode):
-        if container:
-            log.debug("device '%s' not a block device in container."
-                      " cannot resize: %s" % (devpth, info))
-        else:
-            log.warn("device '%s' not a block device. cannot resize: %s" %
-                     (devpth, info))
-        return
+        _skip_warn("device '%s' not a block device. cannot resize: %s",
+                   devpth, info)
 
-    resizer = None
-    if can_skip_resize(fs_type, resize_what, devpth):
+    if can_skip_resize(fstype_lc, resize_what, devpth):
         log.debug("Skip resize filesystem type %s for %s",
                   fs_type, resize_what)
+        _write_resize_sentinel(sentinel, devpth, log)
         return
 
-    fstype_lc = fs_type.lower()
-    for (pfix, root_cmd) in RESIZE_FS_PREFIXES_CMDS:
-        if fstype_lc.startswith(pfix):
-            resizer = root_cmd
-            break
-
+    resizer = _lookup_resizer(fstype_lc)
     if not resizer:
-        log.warn("Not resizing unknown filesystem type %s for %s",
-                 fs_type, resize_what)
-        return
+        _skip_warn("Not resizing unknown filesystem type %s for %s",
+                   fs_type, resize_what)
 
     resize_cmd = resizer(resize_what, devpth)
-    log.debug("Resizing %s (%s) using %s", resize_what, fs_type,
-              ' '.join(resize_cmd))
+    # only pay for joining the command when the line will be emitted
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("Resizing %s (%s) using %s", resize_what, fs_type,
+                  ' '.join(resize_cmd))
 
     if resize_root == NOBLOCK:
-        # Fork to a child that will run
-        # the resize command
-        util.fork_cb(
-            util.log_time, logfunc=log.debug, msg="backgrounded Resizing",
-            func=do_resize, args=(resize_cmd, log))
+        do_resize_noblock(resize_cmd, log, resize_root_d,
+                          devpth=devpth, sentinel=sentinel)
     else:
         util.log_time(logfunc=log.debug, msg="Resizing",
                       func=do_resize, args=(resize_cmd, log))
+        _write_resize_sentinel(sentinel, devpth, log)
 
     action = 'Resized'
     if resize_root == NOBLOCK:
-        action = 'Resizing (via forking)'
+        action = 'Resizing (in background)'
     log.debug("%s root filesystem (type=%s, val=%s)", action, fs_type,
               resize_root)
 
@@ -275,4 +412,51 @@ def do_resize(resize_cmd, log):
     # TODO(harlowja): Should we add a fsck check after this to make
     # sure we didn't corrupt anything?
 
+
+def do_resize_noblock(resize_cmd, log, tmp_d, devpth=None, sentinel=None):
+    # Spawn the resize command directly rather than forking the whole
+    # cloud-init interpreter just to have the child fork again in subp.
+    # The command's output goes to a logfile under tmp_d since there is
+    # no pipe reader once cloud-init has moved on.
+    logname = os.path.join(tmp_d, "cloud-init-resizefs.log")
+    logfd = os.open(logname, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    try:
+        pid = os.posix_spawnp(
+            resize_cmd[0], list(resize_cmd), dict(os.environ),
+            file_actions=[(os.POSIX_SPAWN_DUP2, logfd, 1),
+                          (os.POSIX_SPAWN_DUP2, logfd, 2)])
+    finally:
+        os.close(logfd)
+    log.debug("Backgrounded resize (pid=%s, output to %s)", pid, logname)
+    _watch_resize_pid(pid, log, devpth=devpth, sentinel=sentinel)
+    return pid
+
+
+def _watch_resize_pid(pid, log, devpth=None, sentinel=None):
+    # Sleep on a pidfd until the backgrounded resize exits, so the
+    # child is reaped and its completion logged without dedicating a
+    # forked supervisor to it.  If pidfd_open is unavailable the spawn
+    # stays fire-and-forget as before.
+    try:
+        pidfd = os.pidfd_open(pid)
+    except (AttributeError, OSError):
+        return
+
+    def waiter():
+        try:
+            select.select([pidfd], [], [])
+            (_pid, status) = os.waitpid(pid, 0)
+            exitcode = os.waitstatus_to_exitcode(status)
+            if exitcode == 0:
+                log.debug("Resized root filesystem (background pid=%s)", pid)
+                if sentinel:
+                    _write_resize_sentinel(sentinel, devpth, log)
+            else:
+                log.warn("Backgrounded resize (pid=%s) exited with %s",
+                         pid, exitcode)
+        finally:
+            os.close(pidfd)
+
+    threading.Thread(target=waiter, name="resizefs-wait", daemon=True).start()
+
 # vi: ts=4 expandtab
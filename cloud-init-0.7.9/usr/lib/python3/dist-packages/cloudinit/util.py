@@ -8,6 +8,7 @@
 #
 # This file is part of cloud-init. See LICENSE file for license information.
 
+import collections
 import contextlib
 import copy as obj_copy
 import ctypes
@@ -2011,6 +2012,14 @@ def expand_package_list(version_fmt, pkgs):
     return pkglist
 
 
+# Mount information for a path.  Indexes 0-2 keep tuple-unpacking
+# compatibility with the old (devpth, fs_type, mount_point) return;
+# fs_type_lc carries the lowercased fs_type so callers dispatching on
+# it do not each re-lowercase the string.
+MountInfo = collections.namedtuple(
+    'MountInfo', ['devpth', 'fs_type', 'mount_point', 'fs_type_lc'])
+
+
 def parse_mount_info(path, mountinfo_lines, log=LOG):
     """Return the mount information for PATH given the lines from
     /proc/$$/mountinfo."""
@@ -2179,11 +2188,15 @@ def get_mount_info(path, log=LOG):
     mountinfo_path = '/proc/%s/mountinfo' % os.getpid()
     if os.path.exists(mountinfo_path):
         lines = load_file(mountinfo_path).splitlines()
-        return parse_mount_info(path, lines, log)
+        ret = parse_mount_info(path, lines, log)
     elif os.path.exists("/etc/mtab"):
-        return parse_mtab(path)
+        ret = parse_mtab(path)
     else:
-        return parse_mount(path)
+        ret = parse_mount(path)
+    if ret is None:
+        return None
+    devpth, fs_type, mount_point = ret
+    return MountInfo(devpth, fs_type, mount_point, fs_type.lower())
 
 
 def is_exe(fpath):
@@ -2489,12 +2502,23 @@ def indent(text, prefix):
     return ''.join(lines)
 
 
+_CMDLINE_KV_CACHE = (None, None)
+
+
+def _cmdline_kv(cmdline):
+    # Tokenize a kernel command line into a dict of its key=value
+    # entries.  The command line is immutable for the life of a boot and
+    # several modules parse it repeatedly, so cache the result.
+    global _CMDLINE_KV_CACHE
+    cached, kv = _CMDLINE_KV_CACHE
+    if cached != cmdline:
+        kv = dict(tok.split('=', 1) for tok in cmdline.split() if '=' in tok)
+        _CMDLINE_KV_CACHE = (cmdline, kv)
+    return kv
+
+
 def rootdev_from_cmdline(cmdline):
-    found = None
-    for tok in cmdline.split():
-        if tok.startswith("root="):
-            found = tok[5:]
-            break
+    found = _cmdline_kv(cmdline).get("root")
     if found is None:
         return None
 